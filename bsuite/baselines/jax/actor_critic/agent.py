@@ -15,16 +15,22 @@
 # ============================================================================
 """A simple actor-critic agent implemented in JAX + Haiku."""
 
-from typing import Any, Callable, NamedTuple, Tuple
+import contextlib
+import functools
+import time
+from typing import Any, Callable, NamedTuple, Optional, Tuple
 
 from bsuite.baselines import base
 from bsuite.baselines.utils import sequence
+from bsuite.logging import base as logging_base
 
 import dm_env
 from dm_env import specs
 import haiku as hk
 import jax
 import jax.numpy as jnp
+import jmp
+import numpy as np
 import optax
 import rlax
 
@@ -32,12 +38,212 @@ Logits = jnp.ndarray
 Value = jnp.ndarray
 PolicyValueNet = Callable[[jnp.ndarray], Tuple[Logits, Value]]
 
+DATA_FORMATS = ('NWC', 'NCW')
+
 
 class TrainingState(NamedTuple):
     params: hk.Params
     opt_state: Any
 
 
+class AgentFunctions(NamedTuple):
+    """Pure functions used by the agent to initialize, act and learn."""
+    init: Callable[[jnp.ndarray, jnp.ndarray], hk.Params]
+    policy: Callable[[hk.Params, jnp.ndarray, jnp.ndarray],
+                     Tuple[jnp.ndarray, jnp.ndarray]]
+    sgd_step: Callable[[TrainingState, sequence.Trajectory, int],
+                       Tuple[TrainingState, jnp.ndarray]]
+    start: Callable[[sequence.Trajectory, jnp.ndarray], sequence.Trajectory]
+    append: Callable[..., sequence.Trajectory]
+    learn: Callable[...,
+                    Tuple[TrainingState, sequence.Trajectory, jnp.ndarray]]
+
+
+@functools.lru_cache(maxsize=None)
+def make_functions(
+        network: PolicyValueNet,
+        optimizer: optax.GradientTransformation,
+        discount: float,
+        td_lambda: float,
+) -> AgentFunctions:
+    """Builds the jitted agent functions for a network and hyperparameters.
+
+    Results are cached, so agents built in the same process with the same
+    network and hyperparameters (e.g. a sweep worker running several bsuite_ids)
+    share their compiled XLA executables instead of re-tracing them per agent.
+    """
+
+    # Hyperparameters are fixed per agent: close over them as float32 constants,
+    # so they are folded into the compiled loss rather than traced each call.
+    discount = np.float32(discount)
+    td_lambda = np.float32(td_lambda)
+
+    # Define loss function.
+    def loss(trajectory: sequence.Trajectory, length: jnp.ndarray) -> jnp.ndarray:
+        """"Actor-critic loss over the first `length` steps of the trajectory."""
+        # Rematerialize the network's activations on the backward pass instead
+        # of storing them, so that peak memory does not grow with the sequence
+        # length; the critic targets are computed by a scan inside rlax.
+        remat_network = hk.remat(
+            network, policy=jax.checkpoint_policies.dots_with_no_batch_dims_saveable)
+        logits, values = remat_network(trajectory.observations)
+        # Steps past `length` are stale: mask them out of the loss, and cut the
+        # lambda-return at `length` so that it bootstraps from the last value.
+        # Valid steps share one scalar weight, so means over the whole buffer
+        # equal means over the valid steps without another reduction.
+        sequence_length = trajectory.actions.shape[0]
+        steps = jnp.arange(sequence_length)
+        weights = jnp.where(steps < length, sequence_length / length, 0.)
+        td_errors = rlax.td_lambda(
+            v_tm1=values[:-1],
+            r_t=trajectory.rewards,
+            discount_t=trajectory.discounts * discount,
+            v_t=values[1:],
+            lambda_=jnp.where(steps < length - 1, td_lambda, 0.),
+        )
+        critic_loss = jnp.mean(weights * td_errors ** 2)
+        actor_loss = rlax.policy_gradient_loss(
+            logits_t=logits[:-1],
+            a_t=trajectory.actions,
+            adv_t=td_errors,
+            w_t=weights)
+
+        return actor_loss + critic_loss
+
+    # Transform the network and loss into pure functions in one go, so that they
+    # share a single parameter tree, initialized through the network.
+    def network_and_loss():
+        return network, (network, loss)
+
+    init, (forward, loss_fn) = hk.without_apply_rng(
+        hk.multi_transform(network_and_loss))
+
+    # Define update function; the old state is donated so XLA updates it in place.
+    @functools.partial(jax.jit, donate_argnums=0)
+    def sgd_step(state: TrainingState,
+                 trajectory: sequence.Trajectory,
+                 length: int) -> Tuple[TrainingState, jnp.ndarray]:
+        """Does a step of SGD over a trajectory, also returning the loss."""
+        loss_value, gradients = jax.value_and_grad(loss_fn)(
+            state.params, trajectory, length)
+        updates, new_opt_state = optimizer.update(gradients, state.opt_state)
+        new_params = optax.apply_updates(state.params, updates)
+        new_state = TrainingState(params=new_params, opt_state=new_opt_state)
+        return new_state, loss_value
+
+    # Define acting function; forward pass and sampling compile to one call.
+    @jax.jit
+    def policy(params: hk.Params, key: jnp.ndarray,
+               observation: jnp.ndarray) -> Tuple[jnp.ndarray, jnp.ndarray]:
+        """Samples an action from the softmax policy; also returns the next key."""
+        key, sample_key = jax.random.split(key)
+        logits, _ = forward(params, observation)
+        # Sample from the single row of logits, so the action is a scalar already.
+        action = jax.random.categorical(sample_key, logits[0])
+        return action, key
+
+    # Define buffer functions; the buffer is donated so writes happen in place.
+    @functools.partial(jax.jit, donate_argnums=0)
+    def start(buffer: sequence.Trajectory,
+              observation: jnp.ndarray) -> sequence.Trajectory:
+        """Starts a new sequence in the buffer with an initial observation."""
+        return buffer._replace(
+            observations=buffer.observations.at[0].set(observation))
+
+    @functools.partial(jax.jit, donate_argnums=0)
+    def append(buffer: sequence.Trajectory, t: int, action: base.Action,
+               reward: float, discount: float,
+               observation: jnp.ndarray) -> sequence.Trajectory:
+        """Writes the transition (a, r, d, o') to step `t` of the buffer."""
+        return sequence.Trajectory(
+            observations=buffer.observations.at[t + 1].set(observation),
+            actions=buffer.actions.at[t].set(action),
+            rewards=buffer.rewards.at[t].set(reward),
+            discounts=buffer.discounts.at[t].set(discount),
+        )
+
+    # The step that ends a sequence appends and learns in a single call. SGD
+    # runs over the first `bucket` steps of the buffer only, so that short
+    # sequences (e.g. short episodes) do not pay for the whole buffer.
+    @functools.partial(jax.jit, donate_argnums=(0, 1), static_argnames='bucket')
+    def learn(state: TrainingState, buffer: sequence.Trajectory, t: int,
+              action: base.Action, reward: float, discount: float,
+              observation: jnp.ndarray, *, bucket: int,
+              ) -> Tuple[TrainingState, sequence.Trajectory, jnp.ndarray]:
+        """Appends the last transition of a sequence, then does SGD over it."""
+        buffer = append(buffer, t, action, reward, discount, observation)
+        trajectory = sequence.Trajectory(
+            observations=buffer.observations[:bucket + 1],
+            actions=buffer.actions[:bucket],
+            rewards=buffer.rewards[:bucket],
+            discounts=buffer.discounts[:bucket],
+        )
+        state, loss_value = sgd_step(state, trajectory, t + 1)
+        return state, buffer, loss_value
+
+    return AgentFunctions(init=init, policy=policy, sgd_step=sgd_step,
+                          start=start, append=append, learn=learn)
+
+
+def length_buckets(sequence_length: int) -> Tuple[int, ...]:
+    """Sequence lengths `learn` is compiled for: powers of two, then the full one."""
+    buckets = []
+    bucket = 1
+    while bucket < sequence_length:
+        buckets.append(bucket)
+        bucket *= 2
+    return (*buckets, sequence_length)
+
+
+@functools.lru_cache(maxsize=None)
+def compile_functions(
+        functions: AgentFunctions,
+        optimizer: optax.GradientTransformation,
+        obs_shape: Tuple[int, ...],
+        obs_dtype: np.dtype,
+        sequence_length: int,
+) -> AgentFunctions:
+    """Compiles the agent's functions ahead of time.
+
+    The network runs on fixed batch shapes: a single observation when acting
+    (`init` and `policy`), and one of the `length_buckets` when learning, for
+    which `learn` is compiled once per bucket. Compilation then happens when the agent
+    is built rather than in its first episode, and is a lookup if a persistent
+    compilation cache is configured.
+    The compiled functions only accept the exact input types used here: Python
+    ints for `t` and `action`, and float32 scalars for `reward` and `discount`.
+    """
+    key = jax.ShapeDtypeStruct((2,), jnp.uint32)
+    observation = jax.ShapeDtypeStruct(obs_shape, obs_dtype)
+    observations = jax.ShapeDtypeStruct((1, *obs_shape), obs_dtype)
+    params = jax.eval_shape(functions.init, key, observations)
+    state = TrainingState(params, jax.eval_shape(optimizer.init, params))
+    buffer = sequence.Trajectory(
+        observations=jax.ShapeDtypeStruct((sequence_length + 1, *obs_shape),
+                                          obs_dtype),
+        actions=jax.ShapeDtypeStruct((sequence_length,), jnp.int32),
+        rewards=jax.ShapeDtypeStruct((sequence_length,), jnp.float32),
+        discounts=jax.ShapeDtypeStruct((sequence_length,), jnp.float32),
+    )
+    transition = (0, 0, np.float32(0.), np.float32(0.), observation)
+    learn_executables = {
+        bucket: functions.learn.lower(state, buffer, *transition,
+                                      bucket=bucket).compile()
+        for bucket in length_buckets(sequence_length)
+    }
+
+    def learn(*args, bucket: int):
+        return learn_executables[bucket](*args)
+
+    return functions._replace(
+        init=jax.jit(functions.init).lower(key, observations).compile(),
+        policy=functions.policy.lower(params, key, observations).compile(),
+        start=functions.start.lower(buffer, observation).compile(),
+        append=functions.append.lower(buffer, *transition).compile(),
+        learn=learn,
+    )
+
+
 class ActorCritic(base.Agent):
     """Feed-forward actor-critic agent."""
 
@@ -47,63 +253,56 @@ class ActorCritic(base.Agent):
             action_spec: specs.DiscreteArray,
             network: PolicyValueNet,
             optimizer: optax.GradientTransformation,
-            rng: hk.PRNGSequence,
+            rng: jnp.ndarray,
             sequence_length: int,
             discount: float,
             td_lambda: float,
+            logger: Optional[logging_base.Logger] = None,
     ):
-        # Define loss function.
-        def loss(trajectory: sequence.Trajectory) -> jnp.ndarray:
-            """"Actor-critic loss."""
-            logits, values = network(trajectory.observations)
-            td_errors = rlax.td_lambda(
-                v_tm1=values[:-1],
-                r_t=trajectory.rewards,
-                discount_t=trajectory.discounts * discount,
-                v_t=values[1:],
-                lambda_=jnp.array(td_lambda),
-            )
-            critic_loss = jnp.mean(td_errors ** 2)
-            actor_loss = rlax.policy_gradient_loss(
-                logits_t=logits[:-1],
-                a_t=trajectory.actions,
-                adv_t=td_errors,
-                w_t=jnp.ones_like(td_errors))
-
-            return actor_loss + critic_loss
-
-        # Transform the loss into a pure function.
-        loss_fn = hk.without_apply_rng(hk.transform(loss)).apply
-
-        # Define update function.
-        @jax.jit
-        def sgd_step(state: TrainingState,
-                     trajectory: sequence.Trajectory) -> TrainingState:
-            """Does a step of SGD over a trajectory."""
-            gradients = jax.grad(loss_fn)(state.params, trajectory)
-            updates, new_opt_state = optimizer.update(gradients, state.opt_state)
-            new_params = optax.apply_updates(state.params, updates)
-            return TrainingState(params=new_params, opt_state=new_opt_state)
+        functions = make_functions(network, optimizer, discount, td_lambda)
+        functions = compile_functions(functions, optimizer, obs_spec.shape,
+                                      obs_spec.dtype, sequence_length)
 
         # Initialize network parameters and optimiser state.
-        init, forward = hk.without_apply_rng(hk.transform(network))
-        dummy_observation = jnp.zeros((1, *obs_spec.shape), dtype=jnp.float32)
-        initial_params = init(next(rng), dummy_observation)
+        dummy_observation = jnp.zeros((1, *obs_spec.shape), dtype=obs_spec.dtype)
+        rng, init_rng = jax.random.split(rng)
+        initial_params = functions.init(init_rng, dummy_observation)
         initial_opt_state = optimizer.init(initial_params)
 
         # Internalize state.
         self._state = TrainingState(initial_params, initial_opt_state)
-        self._forward = jax.jit(forward)
-        self._buffer = sequence.Buffer(obs_spec, action_spec, sequence_length)
-        self._sgd_step = sgd_step
-        self._rng = rng
+        self._policy = functions.policy
+        self._rng = rng  # Advanced on device by each call to `policy`.
+
+        # Pre-allocate a fixed-shape trajectory buffer on device.
+        self._buffer = sequence.Trajectory(
+            observations=jnp.zeros((sequence_length + 1, *obs_spec.shape),
+                                   dtype=obs_spec.dtype),
+            actions=jnp.zeros(sequence_length, dtype=jnp.int32),
+            rewards=jnp.zeros(sequence_length, dtype=jnp.float32),
+            discounts=jnp.zeros(sequence_length, dtype=jnp.float32),
+        )
+        self._start = functions.start
+        self._append = functions.append
+        self._learn = functions.learn
+        # The smallest bucket that holds each sequence length.
+        buckets = length_buckets(sequence_length)
+        self._buckets = [min(bucket for bucket in buckets if bucket >= length)
+                         for length in range(sequence_length + 1)]
+        self._sequence_length = sequence_length
+        self._t = 0
+
+        # Losses stay on device until they are logged at the end of an episode.
+        self._logger = logger
+        self._losses = []
 
     def select_action(self, timestep: dm_env.TimeStep) -> base.Action:
         """Selects actions according to a softmax policy."""
-        key = next(self._rng)
         observation = timestep.observation[None, ...]
-        logits, _ = self._forward(self._state.params, observation)
-        action = jax.random.categorical(key, logits).squeeze()
+        action, self._rng = self._policy(self._state.params, self._rng,
+                                         observation)
+        # bsuite environments step on the host, so this is the one device to
+        # host transfer per step; everything else stays on device.
         return int(action)
 
     def update(
@@ -113,22 +312,53 @@ class ActorCritic(base.Agent):
             new_timestep: dm_env.TimeStep,
     ):
         """Adds a transition to the trajectory buffer and periodically does SGD."""
-        self._buffer.append(timestep, action, new_timestep)
-        if self._buffer.full() or new_timestep.last():
-            trajectory = self._buffer.drain()
-            self._state = self._sgd_step(self._state, trajectory)
+        # Start a new sequence with an initial observation, if required.
+        if self._t == 0:
+            self._buffer = self._start(self._buffer, timestep.observation)
+        transition = (self._t, int(action), np.float32(new_timestep.reward),
+                      np.float32(new_timestep.discount), new_timestep.observation)
+        self._t += 1
+
+        # Don't accumulate sequences that cross episode boundaries.
+        if self._t == self._sequence_length or new_timestep.last():
+            self._state, self._buffer, loss = self._learn(
+                self._state, self._buffer, *transition,
+                bucket=self._buckets[self._t])
+            self._t = 0
+            if self._logger is not None:
+                self._losses.append(loss)
+        else:
+            self._buffer = self._append(self._buffer, *transition)
+
+        if self._logger is not None and new_timestep.last():
+            self._logger.write({'loss': float(jnp.mean(jnp.stack(self._losses)))})
+            self._losses = []
 
 
 class CNNTimeSeries(hk.Module):
-    def __init__(self, num_channels: int, output_size: int, name: str = None):
+    def __init__(self, num_channels: int, output_size: int,
+                 data_format: str = 'NWC', name: str = None):
         """
         Args:
         - num_channels: Number of variables in the multivariate time series (input channels).
         - output_size: Number of possible actions (output dimension).
+        - data_format: Layout the convolutions run in, either 'NWC' (channels last)
+                       or 'NCW' (channels first).
+
+        Under a bfloat16 mixed precision policy the input channels are padded to a
+        multiple of 8, so `cnn_time_series/conv1_d`'s `w` has shape
+        (3, ceil8(num_channels), 32)
+        rather than (3, num_channels, 32): parameters saved from a bfloat16 (GPU)
+        network will not load into a full-precision (CPU) one.
         """
         super().__init__(name=name)
+        if data_format not in DATA_FORMATS:
+            raise ValueError(f'Invalid data_format: {data_format}. '
+                             f'Must be one of {DATA_FORMATS}.')
         self.num_channels = num_channels
         self.output_size = output_size
+        self.data_format = data_format
+        self.conv1 = None  # Sublayers are built on the first call.
 
     def __call__(self, inputs: jnp.ndarray) -> Tuple[jnp.ndarray, jnp.ndarray]:
         """
@@ -140,51 +370,148 @@ class CNNTimeSeries(hk.Module):
         - logits: The policy logits for action selection.
         - value: The scalar value estimation for the current state.
         """
-        # Apply 1D Convolution over the time dimension with multiple filters
-        conv1 = hk.Conv1D(output_channels=32, kernel_shape=3, stride=1, padding="SAME")
-        conv2 = hk.Conv1D(output_channels=64, kernel_shape=3, stride=1, padding="SAME")
+        # Build the sublayers once, on the first call, for later calls to reuse.
+        # Built here rather than in `__init__` (or a helper method), they are
+        # named directly under this module (e.g. `cnn_time_series/conv1_d`), as in
+        # the original network, not under a scope such as `cnn_time_series/~/`.
+        if self.conv1 is None:
+            # 1D Convolutions over the time dimension with multiple filters
+            self.conv1 = hk.Conv1D(output_channels=32, kernel_shape=3, stride=1, padding="SAME",
+                                   data_format=self.data_format)
+            self.conv2 = hk.Conv1D(output_channels=64, kernel_shape=3, stride=1, padding="SAME",
+                                   data_format=self.data_format)
+
+            # Fully connected layers
+            self.torso = hk.nets.MLP([128, 64])
+
+            # Policy and Value heads
+            self.policy_head = hk.Linear(self.output_size)
+            self.value_head = hk.Linear(1)
+
+        # Pad channels to a multiple of 8 so bfloat16 convolutions can use TensorCores
+        policy = hk.mixed_precision.current_policy()
+        if policy is not None and policy.compute_dtype == jnp.bfloat16:
+            padding = -self.num_channels % 8
+            inputs = jnp.pad(inputs, ((0, 0), (0, 0), (0, padding)))
+
+        # Move to the convolution layout once; pooling removes the time axis again
+        if self.data_format == 'NCW':
+            inputs = jnp.swapaxes(inputs, 1, 2)
+        time_axis = self.data_format.index('W')
 
         # First convolution
-        x = conv1(inputs)
+        x = self.conv1(inputs)
         x = jax.nn.relu(x)
 
         # Second convolution
-        x = conv2(x)
+        x = self.conv2(x)
         x = jax.nn.relu(x)
 
         # Global Average Pooling (reduces over the time dimension)
-        x = jnp.mean(x, axis=1)  # [batch_size, num_filters]
+        # The time length is static, so the reciprocal is a compile-time constant;
+        # accumulate in float32 as jnp.mean does for bfloat16 inputs.
+        scale = 1.0 / x.shape[time_axis]
+        pooled = x.sum(axis=time_axis, dtype=jnp.float32) * scale
+        x = pooled.astype(x.dtype)  # [batch_size, num_filters]
 
         # Fully connected layers
-        torso = hk.nets.MLP([128, 64])
-        embedding = torso(x)
+        embedding = self.torso(x)
 
         # Policy and Value heads
-        policy_head = hk.Linear(self.output_size)
-        value_head = hk.Linear(1)
-
-        logits = policy_head(embedding)
-        value = jnp.squeeze(value_head(embedding), axis=-1)
+        logits = self.policy_head(embedding)
+        value = jnp.squeeze(self.value_head(embedding), axis=-1)
 
         return logits, value
 
 
+def _precision(policy: Optional[jmp.Policy]):
+    """Returns a context in which `CNNTimeSeries` computes under `policy`.
+
+    The policy is only active inside the context, so other users of the class in
+    the same process keep their own precision (and parameter shapes).
+    """
+    if policy is None:
+        return contextlib.nullcontext()
+    return hk.mixed_precision.push_policy(CNNTimeSeries, policy)
+
+
+@functools.lru_cache(maxsize=None)
+def _fastest_data_format(input_shape: Tuple[int, ...], output_size: int,
+                         policy: Optional[jmp.Policy] = None) -> str:
+    """Times the network once in each data format and returns the fastest."""
+    # XLA's CPU convolutions are channels-last, so there is nothing to gain.
+    if jax.default_backend() == 'cpu':
+        return 'NWC'
+
+    inputs = jnp.zeros(input_shape, dtype=jnp.float32)
+    timings = {}
+    for data_format in DATA_FORMATS:
+        def network(x, data_format=data_format):
+            with _precision(policy):
+                return CNNTimeSeries(input_shape[-1], output_size,
+                                     data_format=data_format)(x)
+
+        init, forward = hk.without_apply_rng(hk.transform(network))
+        params = init(jax.random.PRNGKey(0), inputs)
+        forward = jax.jit(forward)
+        jax.block_until_ready(forward(params, inputs))  # Compile.
+        start = time.perf_counter()
+        for _ in range(10):
+            outputs = forward(params, inputs)
+        jax.block_until_ready(outputs)
+        timings[data_format] = time.perf_counter() - start
+    return min(timings, key=timings.get)
+
+
+@functools.lru_cache(maxsize=None)
+def _default_network(obs_shape: Tuple[int, ...], output_size: int,
+                     batch_size: int) -> PolicyValueNet:
+    """Returns the default network; cached so agents can share compilations."""
+
+    # Compute in bfloat16 on accelerators, keeping parameters, optimizer state
+    # and outputs (hence the loss) in float32. On CPU bfloat16 is emulated, so
+    # the network stays in full precision there.
+    policy = None
+    if jax.default_backend() != 'cpu':
+        policy = jmp.Policy(param_dtype=jnp.float32,
+                            compute_dtype=jnp.bfloat16,
+                            output_dtype=jnp.float32)
+
+    # Pick the data format on the batch the network is trained on.
+    data_format = _fastest_data_format((batch_size, *obs_shape), output_size,
+                                       policy)
+
+    def network(inputs: jnp.ndarray) -> Tuple[Logits, Value]:
+        with _precision(policy):
+            return CNNTimeSeries(num_channels=obs_shape[-1],
+                                 output_size=output_size,
+                                 data_format=data_format)(inputs)
+
+    return network
+
+
+# Cached so that default agents share one optimizer, and hence `make_functions`.
+_adam = functools.lru_cache(maxsize=None)(optax.adam)
+
+
 def default_agent(obs_spec: specs.Array,
                   action_spec: specs.DiscreteArray,
-                  seed: int = 0) -> base.Agent:
+                  seed: int = 0,
+                  logger: Optional[logging_base.Logger] = None) -> base.Agent:
     """Creates an actor-critic agent with default hyperparameters."""
 
-    def network(inputs: jnp.ndarray) -> Tuple[Logits, Value]:
-        return CNNTimeSeries(num_channels=obs_spec.shape[-1],
-                             output_size=action_spec.num_values)(inputs)
+    sequence_length = 32
+    network = _default_network(obs_spec.shape, action_spec.num_values,
+                               batch_size=sequence_length + 1)
 
     return ActorCritic(
         obs_spec=obs_spec,
         action_spec=action_spec,
         network=network,
-        optimizer=optax.adam(3e-3),
-        rng=hk.PRNGSequence(seed),
-        sequence_length=32,
+        optimizer=_adam(3e-3),
+        rng=jax.random.PRNGKey(seed),
+        sequence_length=sequence_length,
         discount=0.99,
         td_lambda=0.9,
+        logger=logger,
     )
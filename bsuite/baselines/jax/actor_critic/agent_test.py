@@ -0,0 +1,188 @@
+# pylint: disable=g-bad-file-header
+# Copyright 2019 DeepMind Technologies Limited. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or  implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Tests for the actor-critic agent's loss and default network."""
+
+from unittest import mock
+
+from absl.testing import absltest
+from absl.testing import parameterized
+
+from bsuite.baselines.jax.actor_critic import agent
+from bsuite.baselines.utils import sequence
+
+import haiku as hk
+import jax
+import jax.numpy as jnp
+import numpy as np
+import optax
+import rlax
+
+_SEQUENCE_LENGTH = 8
+_OBS_SHAPE = (12, 4)
+_NUM_ACTIONS = 3
+_DISCOUNT = 0.99
+_TD_LAMBDA = 0.9
+
+
+def _network(inputs: jnp.ndarray):
+  return agent.CNNTimeSeries(num_channels=_OBS_SHAPE[-1],
+                             output_size=_NUM_ACTIONS)(inputs)
+
+
+def _unmasked_loss(trajectory: sequence.Trajectory) -> jnp.ndarray:
+  """Actor-critic loss over a whole variable-length trajectory."""
+  logits, values = _network(trajectory.observations)
+  td_errors = rlax.td_lambda(
+      v_tm1=values[:-1],
+      r_t=trajectory.rewards,
+      discount_t=trajectory.discounts * _DISCOUNT,
+      v_t=values[1:],
+      lambda_=jnp.array(_TD_LAMBDA),
+  )
+  critic_loss = jnp.mean(td_errors ** 2)
+  actor_loss = rlax.policy_gradient_loss(
+      logits_t=logits[:-1],
+      a_t=trajectory.actions,
+      adv_t=td_errors,
+      w_t=jnp.ones_like(td_errors))
+  return actor_loss + critic_loss
+
+
+def _stale_buffer() -> sequence.Trajectory:
+  """A full buffer of random steps, as stale as the agent's buffer may be."""
+  rng = np.random.RandomState(0)
+  return sequence.Trajectory(
+      observations=rng.randn(_SEQUENCE_LENGTH + 1,
+                             *_OBS_SHAPE).astype(np.float32),
+      actions=rng.randint(_NUM_ACTIONS, size=_SEQUENCE_LENGTH).astype(
+          np.int32),
+      rewards=rng.randn(_SEQUENCE_LENGTH).astype(np.float32),
+      discounts=rng.rand(_SEQUENCE_LENGTH).astype(np.float32),
+  )
+
+
+class LossTest(parameterized.TestCase):
+
+  @parameterized.named_parameters(
+      ('single_step', 1),
+      ('partial_sequence', 5),
+      ('full_sequence', _SEQUENCE_LENGTH),
+  )
+  def test_masked_loss_matches_truncated_trajectory(self, length: int):
+    optimizer = optax.sgd(0.)
+    functions = agent.make_functions(
+        _network, optimizer, _DISCOUNT, _TD_LAMBDA)
+
+    # Steps past `length` hold stale data, as they do in the agent's buffer.
+    buffer = _stale_buffer()
+    truncated = sequence.Trajectory(
+        observations=buffer.observations[:length + 1],
+        actions=buffer.actions[:length],
+        rewards=buffer.rewards[:length],
+        discounts=buffer.discounts[:length],
+    )
+
+    params = functions.init(jax.random.PRNGKey(0), buffer.observations[:1])
+    expected = hk.without_apply_rng(hk.transform(_unmasked_loss)).apply(
+        params, truncated)
+
+    # `sgd_step` donates the training state, so give it its own copy.
+    params = jax.tree_util.tree_map(jnp.array, params)
+    state = agent.TrainingState(params, optimizer.init(params))
+    _, actual = functions.sgd_step(state, buffer, length)
+
+    np.testing.assert_allclose(actual, expected, rtol=1e-5, atol=1e-6)
+
+  @parameterized.named_parameters(
+      ('power_of_two', 2),
+      ('between_buckets', 3),
+  )
+  def test_learn_over_bucket_matches_full_buffer(self, length: int):
+    optimizer = optax.sgd(0.)
+    functions = agent.make_functions(
+        _network, optimizer, _DISCOUNT, _TD_LAMBDA)
+    buckets = agent.length_buckets(_SEQUENCE_LENGTH)
+    bucket = min(bucket for bucket in buckets if bucket >= length)
+    self.assertLess(bucket, _SEQUENCE_LENGTH)
+
+    buffer = _stale_buffer()
+    params = functions.init(jax.random.PRNGKey(0), buffer.observations[:1])
+    transition = (length - 1, 0, np.float32(1.), np.float32(1.),
+                  buffer.observations[0])
+
+    # Both calls donate the state and buffer, so give each its own copy.
+    def copy(tree):
+      return jax.tree_util.tree_map(jnp.array, tree)
+
+    state = agent.TrainingState(copy(params), optimizer.init(params))
+    _, buffer, actual = functions.learn(
+        state, copy(buffer), *transition, bucket=bucket)
+    state = agent.TrainingState(copy(params), optimizer.init(params))
+    _, expected = functions.sgd_step(state, buffer, length)
+
+    np.testing.assert_allclose(actual, expected, rtol=1e-5, atol=1e-6)
+
+
+class CNNTimeSeriesTest(absltest.TestCase):
+
+  def test_data_formats_match(self):
+    inputs = np.random.RandomState(0).randn(2, *_OBS_SHAPE).astype(np.float32)
+    init, forward = {}, {}
+    for data_format in agent.DATA_FORMATS:
+      init[data_format], forward[data_format] = hk.without_apply_rng(
+          hk.transform(lambda x, f=data_format: agent.CNNTimeSeries(
+              _OBS_SHAPE[-1], _NUM_ACTIONS, data_format=f)(x)))
+
+    # Channels-first convolutions keep their biases as [channels, 1].
+    params = init['NWC'](jax.random.PRNGKey(0), inputs)
+    ncw_shapes = jax.eval_shape(init['NCW'], jax.random.PRNGKey(0), inputs)
+    ncw_params = jax.tree_util.tree_map(
+        lambda p, s: p.reshape(s.shape), params, ncw_shapes)
+
+    nwc = forward['NWC'](params, inputs)
+    ncw = forward['NCW'](ncw_params, inputs)
+    for nwc_output, ncw_output in zip(nwc, ncw):
+      np.testing.assert_allclose(nwc_output, ncw_output, rtol=1e-5, atol=1e-6)
+
+  def test_parameter_names(self):
+    params = hk.transform(
+        lambda x: agent.CNNTimeSeries(_OBS_SHAPE[-1], _NUM_ACTIONS)(x)).init(
+            jax.random.PRNGKey(0), jnp.zeros((1, *_OBS_SHAPE)))
+    # Checkpoints of the original network use these paths.
+    self.assertCountEqual(params, [
+        'cnn_time_series/conv1_d',
+        'cnn_time_series/conv1_d_1',
+        'cnn_time_series/mlp/~/linear_0',
+        'cnn_time_series/mlp/~/linear_1',
+        'cnn_time_series/linear',
+        'cnn_time_series/linear_1',
+    ])
+
+  def test_invalid_data_format(self):
+    with self.assertRaises(ValueError):
+      hk.transform(lambda x: agent.CNNTimeSeries(
+          _OBS_SHAPE[-1], _NUM_ACTIONS, data_format='NHWC')(x)).init(
+              jax.random.PRNGKey(0), jnp.zeros((1, *_OBS_SHAPE)))
+
+  def test_fastest_data_format_on_accelerator(self):
+    # Pretend to be on an accelerator, so that both formats are timed.
+    with mock.patch.object(jax, 'default_backend', return_value='gpu'):
+      data_format = agent._fastest_data_format((3, *_OBS_SHAPE), _NUM_ACTIONS)
+    self.assertIn(data_format, agent.DATA_FORMATS)
+
+
+if __name__ == '__main__':
+  absltest.main()
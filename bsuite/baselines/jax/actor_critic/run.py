@@ -15,6 +15,16 @@
 # ============================================================================
 """Run an actor-critic agent instance on a bsuite experiment."""
 
+import os
+
+# The agent's input shapes are fixed (a batch of 1 to act and sequence_length + 1
+# to learn), so exhaustive autotuning of its convolutions is paid once per shape.
+# The tuned executables are then reused via the persistent compilation cache.
+# This must be set before JAX initializes its backends.
+os.environ.setdefault(
+    'XLA_FLAGS', '--xla_gpu_autotune_level=4 '
+                 '--xla_gpu_enable_latency_hiding_scheduler=true')
+
 from absl import app
 from absl import flags
 
@@ -25,6 +35,8 @@ from bsuite.baselines import experiment
 from bsuite.baselines.jax import actor_critic
 from bsuite.baselines.utils import pool
 
+import jax
+
 # Internal imports.
 
 # Experiment flags.
@@ -37,6 +49,9 @@ flags.DEFINE_enum('logging_mode', 'wandb', ['csv', 'sqlite', 'terminal', 'wandb'
 flags.DEFINE_boolean('overwrite', False, 'overwrite csv logging if found')
 flags.DEFINE_integer('num_episodes', None, 'Overrides number of training eps.')
 flags.DEFINE_boolean('verbose', True, 'whether to log to std output')
+flags.DEFINE_string('compilation_cache_dir',
+                    os.environ.get('JAX_COMPILATION_CACHE_DIR', '/tmp/jax_cache'),
+                    'where to cache compiled XLA executables across runs')
 
 # Weights and Biases flags.
 flags.DEFINE_integer('max_episode_length', 1000, 'Maximum episode length')
@@ -44,6 +59,9 @@ flags.DEFINE_string('project_name', 'rl-with-ts-obs', 'Weights and Biases projec
 flags.DEFINE_string('project_entity', 'bolling-adrien', 'Weights and Biases project entity')
 flags.DEFINE_string('project_group', 'ts-bsuite', 'Weights and Biases project group')
 flags.DEFINE_list('project_tags', None, 'Weights and Biases project tags')
+flags.DEFINE_integer('wandb_flush_every', 1, 'Number of bsuite rows (which include '
+                                            'the agent\'s loss) aggregated into each '
+                                            'Weights and Biases row')
 
 FLAGS = flags.FLAGS
 
@@ -90,10 +108,12 @@ def run_with_wandb_logging(bsuite_id: str) -> str:
         project_config=config,
         project_tags=FLAGS.project_tags,
         overwrite=FLAGS.overwrite,
+        flush_every=FLAGS.wandb_flush_every,
     )
 
+    # Also log the agent's training loss, merged into the rows bsuite logs.
     agent = actor_critic.default_agent(
-        env.observation_spec(), env.action_spec())
+        env.observation_spec(), env.action_spec(), logger=env.metrics_logger)
 
     num_episodes = FLAGS.num_episodes or getattr(env, 'bsuite_num_episodes')
     experiment.run(
@@ -102,8 +122,16 @@ def run_with_wandb_logging(bsuite_id: str) -> str:
         num_episodes=num_episodes,
         verbose=FLAGS.verbose)
 
+    # Send any writes still buffered by the logger.
+    env.flush()
+
 
 def main(_):
+    # Cache compiled executables on disk, so that repeated runs and sweep workers
+    # skip compiling the agent. These are small, so cache them however fast.
+    jax.config.update('jax_compilation_cache_dir', FLAGS.compilation_cache_dir)
+    jax.config.update('jax_persistent_cache_min_compile_time_secs', 0)
+
     # Parses whether to run a single bsuite_id, or multiprocess sweep.
     bsuite_id = FLAGS.bsuite_id
 
@@ -216,7 +216,7 @@ def load_and_record_to_csv(bsuite_id: str,
 
 def load_and_record_to_wandb(bsuite_id: str, max_episode_length, project_name: str, project_entity: str, project_group: str,
                              project_config: Dict[str, Any] = None, project_tags: List[str] = None,
-                             overwrite: bool = False) -> dm_env.Environment:
+                             overwrite: bool = False, flush_every: int = 1) -> dm_env.Environment:
     """Returns a bsuite environment that logs to Weights and Biases (wandb).
 
     Args:
@@ -228,6 +228,7 @@ def load_and_record_to_wandb(bsuite_id: str, max_episode_length, project_name: s
         project_config: The configuration of the wandb project.
         project_tags: The tags of the wandb project.
         overwrite: Whether to overwrite existing wandb runs if found.
+        flush_every: Number of writes to aggregate into each wandb row.
 
     Returns:
         A bsuite environment determined by the bsuite_id.
@@ -248,6 +249,7 @@ def load_and_record_to_wandb(bsuite_id: str, max_episode_length, project_name: s
         project_config=project_config,
         project_tags=project_tags,
         overwrite=overwrite,
+        flush_every=flush_every,
     )
 
 
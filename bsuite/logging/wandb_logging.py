@@ -15,7 +15,8 @@
 # ============================================================================
 """Logging functionality for Weights and Biases (wandb) based experiments."""
 
-from typing import Any, List, Dict
+import numbers
+from typing import Any, List, Dict, Optional, Sequence, Tuple
 
 from bsuite import environments
 from bsuite import sweep
@@ -23,12 +24,24 @@ from bsuite.logging import base
 from bsuite.utils import wrappers
 
 import dm_env
+import numpy as np
 import wandb
 
 SAFE_SEPARATOR = '-'
 INITIAL_SEPARATOR = '_-_'
 BSUITE_PREFIX = 'bsuite_id' + INITIAL_SEPARATOR
 
+# Running totals logged by bsuite (besides any 'total_*' key): aggregated rows
+# keep their latest value rather than an average that never happened.
+CUMULATIVE_KEYS = frozenset(
+    ['steps', 'episode', 'raw_return', 'denoised_return', 'best_episode'])
+
+# The wandb run shared by loggers in this process, started lazily, with the
+# (project, entity, group) it logs to and the bsuite_ids that have logged to it.
+_RUN = None
+_RUN_KEY: Optional[Tuple[str, str, str]] = None
+_RUN_BSUITE_IDS: List[str] = []
+
 
 def wrap_environment(env: environments.Environment,
                      bsuite_id: str,
@@ -38,10 +51,11 @@ def wrap_environment(env: environments.Environment,
                      project_config: Dict[str, Any] = None,
                      project_tags: List[str] = None,
                      overwrite: bool = False,
-                     log_by_step: bool = False) -> dm_env.Environment:
+                     log_by_step: bool = False,
+                     flush_every: int = 1) -> dm_env.Environment:
     """Returns a wrapped environment that logs using wandb."""
     logger = WandbLogger(bsuite_id, project_name, project_entity, project_group, project_config, project_tags,
-                         overwrite)
+                         overwrite, flush_every)
     return wrappers.Logging(env, logger, log_by_step=log_by_step)
 
 
@@ -51,6 +65,23 @@ class WandbLogger(base.Logger):
   This simplified logger sends bsuite experiment metrics to wandb.
   Each bsuite_id logs under a specific project and experiment ID.
   The logger is initialized with a project name and bsuite_id.
+
+  Starting a wandb run is slow, so loggers in the same process (e.g. a sweep
+  worker visiting several bsuite_ids) share a single run, as long as they log
+  to the same project, entity and group and the run is still the active one
+  (i.e. it was not finished with `wandb.finish()`). The experiment that
+  starts the run logs its metrics under their plain names; each experiment that
+  joins it later namespaces its metrics under its experiment name and records
+  its bsuite_id and config in the run's config. Pass `overwrite=True` to start
+  a new run instead.
+
+  Each call to `wandb.log` has a fixed serialization and IPC cost, so writes
+  can be buffered: every `flush_every` writes are sent as a single row holding
+  the latest value of each cumulative metric (e.g. `episode`, `total_return`),
+  and the mean of each other numeric metric over the writes that contain it.
+  Metrics that change more often than bsuite logs (e.g. an agent's loss) should
+  go through the `Logging` wrapper's `metrics_logger`, which merges them into
+  bsuite's rows, so the default `flush_every=1` is one `wandb.log` per row.
   """
 
     def __init__(self,
@@ -60,18 +91,62 @@ class WandbLogger(base.Logger):
                  project_group: str,
                  project_config: Dict[str, Any] = None,
                  project_tags: List[str] = None,
-                 overwrite: bool = False):
+                 overwrite: bool = False,
+                 flush_every: int = 1):
         """Initializes a new wandb logger."""
 
         # The default '/' symbol is dangerous for file systems!
         safe_bsuite_id = bsuite_id.replace(sweep.SEPARATOR, SAFE_SEPARATOR)
         experiment_name = f'{BSUITE_PREFIX}{safe_bsuite_id}'
 
-        # Start a new wandb run
-        wandb.init(project=project_name, entity=project_entity, group=project_group,
-                   config=project_config, tags=project_tags, reinit=overwrite)
+        # Start a wandb run, unless this process already has one to share.
+        global _RUN, _RUN_KEY
+        run_key = (project_name, project_entity, project_group)
+        if _RUN is not None and _RUN is not wandb.run:
+            _RUN = None  # Finished elsewhere.
+        if _RUN is None or overwrite or run_key != _RUN_KEY:
+            _RUN = wandb.init(project=project_name, entity=project_entity, group=project_group,
+                              config=project_config, tags=project_tags,
+                              reinit=overwrite or _RUN is not None)
+            _RUN_KEY = run_key
+            _RUN_BSUITE_IDS[:] = [bsuite_id]
+            self._prefix = None
+        else:
+            _RUN_BSUITE_IDS.append(bsuite_id)
+            _RUN.config.update({'bsuite_ids': list(_RUN_BSUITE_IDS),
+                                experiment_name: dict(project_config or {}, bsuite_id=bsuite_id)},
+                               allow_val_change=True)
+            self._prefix = experiment_name
+        self._run = _RUN
+        self._flush_every = flush_every
+        self._buffer: List[Dict[str, Any]] = []
 
     def write(self, data: dict[str, Any]):
-        """Logs data to wandb."""
-        # Log the dictionary data to wandb as metrics
-        wandb.log(data)
+        """Buffers data, logging it to wandb every `flush_every` writes."""
+        self._buffer.append(dict(data))
+        if len(self._buffer) >= self._flush_every:
+            self.flush()
+
+    def flush(self):
+        """Logs any buffered data to wandb as a single row."""
+        if not self._buffer:
+            return
+        if len(self._buffer) == 1:
+            data = self._buffer[0]
+        else:
+            keys = dict.fromkeys(key for row in self._buffer for key in row)
+            data = {key: _aggregate(key, [row[key] for row in self._buffer if key in row])
+                    for key in keys}
+        # Log the dictionary data to wandb as metrics, namespaced if the run is shared
+        if self._prefix is not None:
+            data = {f'{self._prefix}/{key}': value for key, value in data.items()}
+        self._run.log(data)
+        self._buffer = []
+
+
+def _aggregate(key: str, values: Sequence[Any]) -> Any:
+    """Averages numeric values of a non-cumulative key, else keeps the latest."""
+    cumulative = key in CUMULATIVE_KEYS or key.startswith('total_')
+    if not cumulative and all(isinstance(value, numbers.Number) for value in values):
+        return float(np.mean(values))
+    return values[-1]
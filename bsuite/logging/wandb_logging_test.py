@@ -0,0 +1,166 @@
+# pylint: disable=g-bad-file-header
+# Copyright 2019 DeepMind Technologies Limited. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or  implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Tests for bsuite.logging.wandb_logging."""
+
+from unittest import mock
+
+from absl.testing import absltest
+from bsuite.environments import catch
+from bsuite.logging import wandb_logging
+from bsuite.utils import wrappers
+
+
+class WandbLoggerTest(absltest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    # Stub out wandb, and start every test without a shared run.
+    self.wandb = self.enter_context(mock.patch.object(wandb_logging, 'wandb'))
+    self.enter_context(mock.patch.object(wandb_logging, '_RUN', None))
+    self.enter_context(mock.patch.object(wandb_logging, '_RUN_KEY', None))
+    self.enter_context(mock.patch.object(wandb_logging, '_RUN_BSUITE_IDS', []))
+
+    # Like wandb, each new run becomes the active `wandb.run`.
+    self.runs = []
+
+    def init(**kwargs):
+      del kwargs
+      self.wandb.run = mock.MagicMock()
+      self.runs.append(self.wandb.run)
+      return self.wandb.run
+
+    self.wandb.init.side_effect = init
+
+  def _logger(self, bsuite_id='catch/0', project_name='project', **kwargs):
+    return wandb_logging.WandbLogger(
+        bsuite_id, project_name, 'entity', 'group',
+        project_config={'bsuite_id': bsuite_id}, **kwargs)
+
+  def _logged_rows(self, run_index=-1):
+    if not self.runs:
+      return []
+    return [call.args[0] for call in self.runs[run_index].log.call_args_list]
+
+  def test_writes_unbuffered_by_default(self):
+    logger = self._logger()
+    logger.write({'episode': 1, 'total_return': 1.0})
+    logger.write({'episode': 2, 'total_return': 3.0})
+    self.assertEqual(self._logged_rows(), [
+        {'episode': 1, 'total_return': 1.0},
+        {'episode': 2, 'total_return': 3.0},
+    ])
+
+  def test_buffers_until_flush_every(self):
+    logger = self._logger(flush_every=3)
+    logger.write({'episode': 1})
+    logger.write({'episode': 2})
+    self.assertEmpty(self._logged_rows())
+    logger.write({'episode': 3})
+    self.assertLen(self._logged_rows(), 1)
+
+  def test_flush_sends_partial_buffer_once(self):
+    logger = self._logger(flush_every=10)
+    logger.write({'episode': 1})
+    logger.flush()
+    logger.flush()
+    self.assertEqual(self._logged_rows(), [{'episode': 1}])
+
+  def test_aggregation(self):
+    logger = self._logger(flush_every=4)
+    logger.write({'steps': 10, 'episode': 1, 'total_return': 1.0,
+                  'total_regret': 0.0, 'episode_return': 1.0})
+    logger.write({'loss': 0.5})
+    logger.write({'steps': 25, 'episode': 2, 'total_return': 4.0,
+                  'total_regret': 1.0, 'episode_return': 3.0})
+    logger.write({'loss': 1.5, 'note': 'last'})
+
+    # Running totals keep their latest value; every other number is averaged
+    # over the writes that contain it, and anything else keeps its latest value.
+    self.assertEqual(self._logged_rows(), [{
+        'steps': 25,
+        'episode': 2,
+        'total_return': 4.0,
+        'total_regret': 1.0,
+        'episode_return': 2.0,
+        'loss': 1.0,
+        'note': 'last',
+    }])
+
+  def test_metrics_follow_bsuite_rows(self):
+    env = wandb_logging.wrap_environment(
+        catch.Catch(seed=0), 'catch/0', 'project', 'entity', 'group')
+
+    num_episodes = 100
+    for _ in range(num_episodes):
+      timestep = env.reset()
+      while not timestep.last():
+        timestep = env.step(0)
+      env.metrics_logger.write({'loss': 1.})
+    env.flush()
+
+    # Metrics written every episode add no rows of their own.
+    num_bsuite_rows = sum(wrappers._logarithmic_logging(episode)
+                          for episode in range(1, num_episodes + 1))
+    rows = self._logged_rows()
+    self.assertLen(rows, num_bsuite_rows)
+    self.assertNotIn('loss', rows[0])
+    self.assertEqual(rows[-1]['loss'], 1.)
+
+  def test_loggers_share_one_run(self):
+    self._logger('catch/0').write({'episode': 1})
+    self._logger('catch/1').write({'episode': 1})
+
+    self.wandb.init.assert_called_once()
+    self.assertEqual(self._logged_rows(), [
+        {'episode': 1},
+        {'bsuite_id_-_catch-1/episode': 1},
+    ])
+    self.runs[0].config.update.assert_called_once_with(
+        {'bsuite_ids': ['catch/0', 'catch/1'],
+         'bsuite_id_-_catch-1': {'bsuite_id': 'catch/1'}},
+        allow_val_change=True)
+
+  def test_overwrite_starts_a_new_run(self):
+    self._logger('catch/0')
+    logger = self._logger('catch/1', overwrite=True)
+    logger.write({'episode': 1})
+
+    self.assertEqual(self.wandb.init.call_count, 2)
+    self.assertEqual(self._logged_rows(), [{'episode': 1}])
+
+  def test_other_project_starts_a_new_run(self):
+    self._logger('catch/0').write({'episode': 1})
+    self._logger('catch/1', project_name='other_project').write({'episode': 1})
+
+    # Each experiment has a run of its own, under its plain metric names.
+    self.assertEqual(self.wandb.init.call_count, 2)
+    self.assertEqual(self.wandb.init.call_args.kwargs['project'],
+                     'other_project')
+    self.assertEqual(self._logged_rows(0), [{'episode': 1}])
+    self.assertEqual(self._logged_rows(1), [{'episode': 1}])
+    self.runs[0].config.update.assert_not_called()
+
+  def test_finished_run_is_not_reused(self):
+    self._logger('catch/0')
+    self.wandb.run = None  # As after `wandb.finish()`.
+    self._logger('catch/1').write({'episode': 1})
+
+    self.assertEqual(self.wandb.init.call_count, 2)
+    self.assertEqual(self._logged_rows(), [{'episode': 1}])
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -16,7 +16,7 @@
 """bsuite logging and image observation wrappers."""
 from abc import ABC
 from functools import reduce
-from typing import Any, Dict, Optional, Sequence
+from typing import Any, Dict, List, Mapping, Optional, Sequence
 
 from bsuite import environments
 from bsuite.logging import base
@@ -32,6 +32,29 @@ STANDARD_KEYS = frozenset(
     ['steps', 'episode', 'total_return', 'episode_len', 'episode_return'])
 
 
+class MetricsLogger(base.Logger):
+    """Collects numeric metrics, e.g. an agent's loss, between bsuite rows.
+
+  The `Logging` wrapper merges them into its next row of bsuite data, as the
+  mean of each metric over the writes since the previous row, so that extra
+  metrics follow bsuite's logging schedule instead of adding rows of their own.
+  """
+
+    def __init__(self):
+        self._rows: List[Dict[str, Any]] = []
+
+    def write(self, data: Mapping[str, Any]):
+        self._rows.append(dict(data))
+
+    def pop(self) -> Dict[str, float]:
+        """Returns the mean of each metric written since the last call."""
+        keys = dict.fromkeys(key for row in self._rows for key in row)
+        data = {key: float(np.mean([row[key] for row in self._rows if key in row]))
+                for key in keys}
+        self._rows = []
+        return data
+
+
 class Logging(dm_env.Environment):
     """Environment wrapper to track and log bsuite stats."""
 
@@ -53,6 +76,7 @@ class Logging(dm_env.Environment):
         self._logger = logger
         self._log_by_step = log_by_step
         self._log_every = log_every
+        self._metrics_logger = MetricsLogger()
 
         # Accumulating throughout experiment.
         self._steps = 0
@@ -121,10 +145,17 @@ class Logging(dm_env.Environment):
             episode_len=self._episode_len,
             episode_return=self._episode_return,
         )
+        # Extra metrics written since the last row, e.g. by the agent.
+        data.update(self._metrics_logger.pop())
         # Environment-specific metadata used for scoring.
         data.update(self._env.bsuite_info())
         self._logger.write(data)
 
+    @property
+    def metrics_logger(self) -> MetricsLogger:
+        """A logger whose writes are merged into the next row of bsuite data."""
+        return self._metrics_logger
+
     @property
     def raw_env(self):
         # Recursively unwrap until we reach the true 'raw' env.
@@ -120,6 +120,33 @@ class WrapperTest(absltest.TestCase):
           )
     mock_logger.write.assert_has_calls(expected_calls)
 
+  def test_metrics_merged_into_next_row(self):
+    mock_logger = mock.MagicMock()
+    timesteps = [
+        dm_env.restart([]),
+        dm_env.transition(1, []),
+        dm_env.termination(2, []),
+    ]
+    env = wrappers.Logging(env=FakeEnvironment(timesteps), logger=mock_logger,
+                           log_every=True)  # pytype: disable=wrong-arg-types
+
+    # Metrics written between rows add no rows of their own.
+    env.metrics_logger.write({'loss': 1.})
+    env.metrics_logger.write({'loss': 3.})
+    mock_logger.write.assert_not_called()
+
+    for _ in range(2):
+      timestep = env.reset()
+      while not timestep.last():
+        timestep = env.step(action=0)
+
+    # The first row averages the pending metrics; the second has none left.
+    first_row, second_row = [call.args[0] for call in
+                             mock_logger.write.call_args_list]
+    self.assertEqual(first_row['loss'], 2.)
+    self.assertEqual(first_row['episode'], 1)
+    self.assertNotIn('loss', second_row)
+
   def test_unwrap(self):
     raw_env = FakeEnvironment([dm_env.restart([])])
     scale_env = wrappers.RewardScale(raw_env, reward_scale=1.)
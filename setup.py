@@ -38,6 +38,7 @@ baselines_jax_require = [
     'dm-tree',
     'jax',
     'jaxlib',
+    'jmp',
     'optax',
     'rlax',
     'tqdm',